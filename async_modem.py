@@ -0,0 +1,288 @@
+"""A small asyncio driver for the AT commands the water alarm needs.
+
+The serial port is read through pyserial-asyncio-fast, so waiting for the
+modem happens on the event loop instead of blocking a thread.
+"""
+import asyncio
+import contextlib
+import logging
+import re
+from typing import NamedTuple
+
+import serial_asyncio_fast
+
+logger = logging.getLogger(__name__)
+
+FINAL_RESPONSES = (b"OK", b"ERROR", b"+CME ERROR", b"+CMS ERROR", b"NO CARRIER")
+CMGL_HEADER = re.compile(r'^\+CMGL: (\d+),"[^"]*","([^"]*)",[^,]*,"([^"]*)"')
+CSQ_RESPONSE = re.compile(r"^\+CSQ: (\d+),")
+CMTI_INDICATION = re.compile(rb'^\+CMTI: "[^"]*",(\d+)')
+ABORT_TIMEOUT = 1  # seconds to wait for the modem to confirm cancelled message input
+
+# GSM 03.38 default alphabet and the characters reached through its escape code
+GSM_ALPHABET = ("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM_EXTENSION = {"^": 0x14, "{": 0x28, "}": 0x29, "\\": 0x2F, "[": 0x3C, "~": 0x3D, "]": 0x3E, "|": 0x40, "€": 0x65}
+
+
+class CommandError(Exception):
+    """Raised when the modem answers a command with an error."""
+
+
+class Sms(NamedTuple):
+    """A text message read from the modem's storage."""
+    index: int
+    number: str
+    time: str
+    text: str
+
+
+def encode_user_data(text: str) -> tuple:
+    """Encodes a message body for an SMS-SUBMIT PDU.
+
+    Returns the data coding scheme, the user data length and the user data.
+    Uses the GSM 7-bit alphabet where possible and UCS2 otherwise.
+    """
+    septets = []
+    for char in text:
+        if char in GSM_EXTENSION:
+            septets += [0x1B, GSM_EXTENSION[char]]
+        elif char in GSM_ALPHABET:
+            septets.append(GSM_ALPHABET.index(char))
+        else:
+            break
+    else:
+        if len(septets) > 160:
+            raise ValueError(f"Message is too long for a single SMS: '{text}'")
+        packed = bytearray()
+        value = bits = 0
+        for septet in septets:
+            value |= septet << bits
+            bits += 7
+            while bits >= 8:
+                packed.append(value & 0xFF)
+                value >>= 8
+                bits -= 8
+        if bits:
+            packed.append(value)
+        return 0x00, len(septets), bytes(packed)
+    data = text.encode("utf-16-be")
+    if len(data) > 140:
+        raise ValueError(f"Message is too long for a single SMS: '{text}'")
+    return 0x08, len(data), data
+
+
+def encode_address(number: str) -> bytes:
+    """Encodes a phone number as a PDU destination address. Raises ValueError if it isn't just digits with an optional leading '+'."""
+    digits = number[1:] if number.startswith("+") else number
+    if not digits.isdigit():
+        raise ValueError(f"Invalid phone number '{number}'")
+    address_type = 0x91 if number.startswith("+") else 0x81
+    padded = digits + "F" if len(digits) % 2 else digits
+    swapped = "".join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+    return bytes([len(digits), address_type]) + bytes.fromhex(swapped)
+
+
+class AsyncGsmModem:
+    def __init__(self, port: str, baudrate: int, timeout: float = 10):
+        """Talks to a GSM modem on a serial port using AT commands.
+
+        port: The serial port the modem is connected to, e.g. "/dev/ttyS0".
+        baudrate: The baudrate of the serial port.
+        timeout: The time in seconds to wait for the modem to answer a command. Defaults to 10.
+
+        Await the connect method before sending any commands. Set
+        'sms_received_callback' to a function taking the storage index to be
+        told when the modem stores a new message.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._lock = asyncio.Lock()
+        self._response = None
+        self._response_lines = []
+        self._prompt = None
+        self._sms_text_next = False
+        self._text_mode = None
+        self.sms_received_callback = None
+
+    async def connect(self):
+        """Opens the serial port and puts the modem into text mode.
+
+        Can be awaited again after a failure; the port is only reopened if
+        reading from it has stopped.
+        """
+        if self._read_task is None or self._read_task.done():
+            self.close()
+            self._reader, self._writer = await serial_asyncio_fast.open_serial_connection(url=self.port, baudrate=self.baudrate)
+            self._read_task = asyncio.create_task(self._read_loop())
+        self._text_mode = None
+        async with self._session(text_mode=True):
+            await self._command("ATE0")  # no command echo
+            await self._command("AT+CMEE=1")  # numeric error codes
+            await self._command('AT+CSCS="GSM"')
+            await self._command("AT+CNMI=2,1")  # store new messages and report them with +CMTI
+
+    def close(self):
+        """Stops reading from the modem and closes the serial port."""
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    @contextlib.asynccontextmanager
+    async def _session(self, text_mode: bool):
+        """Holds the lock with the modem in text or PDU mode, so no other command can switch modes in between."""
+        async with self._lock:
+            if self._text_mode != text_mode:
+                await self._command(f"AT+CMGF={int(text_mode)}")
+                self._text_mode = text_mode
+            yield
+
+    async def command(self, command: str, payload: str = None, timeout: float = None) -> list:
+        """Sends an AT command and returns the lines of its response.
+
+        If 'payload' is given, it is sent after the modem's '>' prompt and
+        terminated with Ctrl-Z, as needed for AT+CMGS.
+        """
+        async with self._lock:
+            return await self._command(command, payload, timeout)
+
+    async def _command(self, command: str, payload: str = None, timeout: float = None) -> list:
+        """Sends an AT command like 'command' does. Must be called with the lock held."""
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        self._response = loop.create_future()
+        self._response_lines = []
+        self._sms_text_next = False
+        self._prompt = loop.create_future() if payload is not None else None
+        try:
+            logger.debug("write: %s", command)
+            self._writer.write(command.encode() + b"\r")
+            if payload is not None:
+                done, _ = await asyncio.wait({self._prompt, self._response}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    await self._abort_input()
+                    raise asyncio.TimeoutError(f"No prompt after {command}")
+                if self._prompt in done:
+                    logger.debug("write: %s", payload)
+                    self._writer.write(payload.encode() + b"\x1a")
+            try:
+                return await asyncio.wait_for(self._response, timeout)
+            except asyncio.TimeoutError:
+                if payload is not None:
+                    await self._abort_input()
+                raise
+        finally:
+            self._response = None
+            self._prompt = None
+
+    async def _abort_input(self):
+        """Cancels message input with ESC so later commands aren't taken as text.
+
+        The modem's answer to the cancelled input is waited for and discarded,
+        so it can't complete the next command. Must be called with the lock held.
+        """
+        self._prompt = None
+        self._response = asyncio.get_running_loop().create_future()
+        self._response_lines = []
+        self._writer.write(b"\x1b")
+        try:
+            await asyncio.wait_for(self._response, ABORT_TIMEOUT)
+        except (asyncio.TimeoutError, CommandError):
+            pass
+
+    async def _read_loop(self):
+        """Reads lines from the modem and hands them to the pending command or the new message callback."""
+        buffer = b""
+        try:
+            while True:
+                data = await self._reader.read(1024)
+                if not data:
+                    raise ConnectionError("The modem's serial port was closed.")
+                buffer += data
+                while b"\r\n" in buffer:
+                    line, buffer = buffer.split(b"\r\n", 1)
+                    if line or self._sms_text_next:  # an empty line can be an empty message
+                        self._handle_line(line)
+                if buffer.startswith(b">"):
+                    buffer = b""
+                    if self._prompt is not None and not self._prompt.done():
+                        self._prompt.set_result(None)
+        except Exception as e:
+            if self._response is not None and not self._response.done():
+                self._response.set_exception(e)
+            raise
+
+    def _handle_line(self, line: bytes):
+        logger.debug("read: %s", line)
+        indication = CMTI_INDICATION.match(line)
+        if indication:
+            if self.sms_received_callback is not None:
+                self.sms_received_callback(int(indication.group(1)))
+            return
+        if self._response is None or self._response.done():
+            logger.debug("Ignoring unsolicited %s", line)
+            return
+        if self._sms_text_next:
+            # the line after a +CMGL header is message text, even if it reads "OK" or "ERROR"
+            self._sms_text_next = False
+            self._response_lines.append(line.decode(errors="replace"))
+        elif line.startswith(FINAL_RESPONSES):
+            if line == b"OK":
+                self._response.set_result(self._response_lines)
+            else:
+                self._response.set_exception(CommandError(line.decode(errors="replace")))
+        else:
+            self._sms_text_next = line.startswith(b"+CMGL:")
+            self._response_lines.append(line.decode(errors="replace"))
+
+    async def list_stored_sms(self, delete: bool = False) -> list:
+        """Returns all messages in the modem's storage, optionally deleting them afterwards."""
+        messages = []
+        async with self._session(text_mode=True):
+            for line in await self._command('AT+CMGL="ALL"'):
+                header = CMGL_HEADER.match(line)
+                if header:
+                    index, number, time = header.groups()
+                    messages.append(Sms(int(index), number, time, ""))
+                elif messages:
+                    text = messages[-1].text + "\n" + line if messages[-1].text else line
+                    messages[-1] = messages[-1]._replace(text=text)
+            if delete:
+                for message in messages:
+                    await self._command(f"AT+CMGD={message.index}")
+        return messages
+
+    async def send_sms_batch(self, numbers: list, text: str) -> dict:
+        """Sends the same text message to every number in 'numbers' in one PDU mode session.
+
+        The message body is only encoded once. Returns the exceptions raised
+        for the numbers that could not be sent to, keyed by number.
+        """
+        dcs, length, user_data = encode_user_data(text)
+        failed = {}
+        async with self._session(text_mode=False):
+            for number in numbers:
+                try:
+                    # SMS-SUBMIT, message reference, destination, protocol id, coding scheme, user data
+                    tpdu = bytes([0x01, 0x00]) + encode_address(number) + bytes([0x00, dcs, length]) + user_data
+                    # the leading 00 makes the modem use its stored SMSC
+                    await self._command(f"AT+CMGS={len(tpdu)}", payload="00" + tpdu.hex().upper(), timeout=60)
+                except Exception as e:
+                    failed[number] = e
+        return failed
+
+    async def signal_strength(self) -> int:
+        """Returns the received signal strength (0-31), or -1 if it is unknown."""
+        for line in await self.command("AT+CSQ"):
+            match = CSQ_RESPONSE.match(line)
+            if match:
+                rssi = int(match.group(1))
+                return -1 if rssi == 99 else rssi
+        raise CommandError("No signal strength in AT+CSQ response.")
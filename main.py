@@ -1,17 +1,42 @@
 import seeed_relay_v1
-import logging as log
-import gsmmodem
+import logging
+import asyncio
 import dotenv
-import time
 import json
 import os
+import queue
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from async_modem import AsyncGsmModem
 
-dotenv.load_dotenv()
-          
-logging = False # human readable send and recieve 
+log_messages = False # human readable send and receive
 log_everything = False # direct modem ouput
 debug = False # run 5x faster for testing
 
+logger = logging.getLogger("wateralarm")
+logger.setLevel(logging.DEBUG if log_everything else logging.INFO if log_messages else logging.WARNING)
+
+# (alert state, event) -> new alert state; events not listed don't alert anyone
+ALERT_TRANSITIONS = {
+    ("NORMAL", "water"): "WATER",
+    ("NORMAL", "disconnect"): "DISCONNECTED",
+    ("WATER", "removed"): "NORMAL",
+    ("WATER", "disconnect"): "WATER_DISCONNECTED",
+    ("DISCONNECTED", "restored"): "NORMAL",
+    ("WATER_DISCONNECTED", "restored"): "WATER",
+}
+
+MAX_SEND_ATTEMPTS = 5  # per message and number, before the sender gives up on it
+
+def normalise_number(number: str) -> str:
+    """Strips spaces and dashes from a phone number. Raises ValueError if anything but digits and a leading '+' is left."""
+    stripped = number.replace(" ", "").replace("-", "")
+    if not re.fullmatch(r"\+?\d+", stripped):
+        raise ValueError(f"Invalid phone number '{number}'")
+    return stripped
+
 class WaterAlarm:
     def __init__(self,
                  alert_phone_numbers: list,
@@ -25,14 +50,13 @@ class WaterAlarm:
                  amber_relay: int = 2,
                  green_relay: int = 3,
                  disconnect_time: int = 10,
-                 water_time: int = 10,
-                 log: bool = True):
+                 water_time: int = 10):
         """Communicates with another device via SMS. If it returns a certain
          value after a certain request, turns a certain relay on. Can also
          send messages to people to inform them of the situation. In this
          case, it communicates with a water sensor.
 
-        phone_number: The phone number to communicate with.
+        phone_number: The phone number to communicate with. Spaces and dashes are removed.
         request_message: The message to send to the other device to request its status. Defaults to "Water?".
         water_message: The expected return message when water is detected. Defaults to "1".
         no_water_message: The expected return message when no water is detected. Defaults to "0".
@@ -41,14 +65,13 @@ class WaterAlarm:
         red_relay: The number of the relay connected to the red light. Defaults to 1.
         amber_relay: The number of the relay connected to the amber light. Defaults to 2.
         green_relay: The number of the relay connected to the green light. Defaults to 3.
-        alert_phone_numbers: The phone numbers to alert when signal is lost or water is detected.
+        alert_phone_numbers: The phone numbers to alert when signal is lost or water is detected. Spaces and dashes are removed.
         disconnect_time: The time in minutes to wait before signalling a disconnect. Must be a multiple of 2. Defaults to 10.
         water_time: The time in minutes that water must be detected for before signalling water. Must be a muliple of 2. Defaults to 10.
-        log: Logs the sending and receiving of messages to the console. Errors, disconnects and water detections are always logged. Defaults to True.
 
-        Call the mainloop method to start the communication.
+        Run the mainloop coroutine to start the communication.
         """
-        self.phone_number = phone_number
+        self.phone_number = normalise_number(phone_number)
         self.request_message = request_message
         self.water_message = water_message
         self.no_water_message = no_water_message
@@ -56,190 +79,308 @@ class WaterAlarm:
         self.red_relay = red_relay
         self.amber_relay = amber_relay
         self.green_relay = green_relay
-        self.alert_numbers = alert_phone_numbers
+        self.alert_numbers = [normalise_number(number) for number in alert_phone_numbers]
         self.water_time = water_time
         self.disconnect_time = disconnect_time
-        self.log = log_everything
         self.debug = debug
-        if self.disconnect_time % 2 != 0:
+        if self.water_time % 2 != 0:
             raise ValueError("'water_time' must be a multiple of 2!")
         if self.disconnect_time % 2 != 0:
             raise ValueError("'disconnect_time' must be a multiple of 2!")
-        if self.log:
-            print("Connecting modem")
+        # both are counted in two minute loops
+        self._water_threshold = water_time // 2
+        self._disconnect_threshold = disconnect_time // 2
+        self._message_handlers = {water_message: self._on_water, no_water_message: self._on_no_water}
+        self.baudrate = baudrate
+        logger.info("Connecting relay board")
+        self.relay_board = seeed_relay_v1.Relay(device_address=relay_board_address)
+        self._light_masks = {"red": 1 << (red_relay - 1), "amber": 1 << (amber_relay - 1), "green": 1 << (green_relay - 1)}
+        self._lights_mask = self._light_masks["red"] | self._light_masks["amber"] | self._light_masks["green"]
+        self._current_mask = 0
+        # _set_relays writes the board's register directly if this version of the library exposes it
+        self._register_access = all(hasattr(self.relay_board, name) for name in ("bus", "DEVICE_ADDRESS", "DEVICE_REG_MODE1", "DEVICE_REG_DATA"))
+        if not self._register_access:
+            logger.warning("seeed_relay_v1.Relay doesn't expose its register, switching relays one at a time.")
+        self.missing_responses = 0
+        self.missing_loops = 0
+        self.awaiting_message = False
+        self.water = False
+        self.times_water_detected = 0
+        self._state = "NORMAL"
+        self._last_csq = None
+        self._last_csq_time = float("-inf")
+
+    async def connect(self):
+        """Connects the modem and flashes every light once to show the alarm is up."""
+        logger.info("Connecting modem")
+        self.new_sms = asyncio.Event()
+        self._send_queue = asyncio.Queue()
+        self.modem = AsyncGsmModem("/dev/ttyS0", self.baudrate)
+        self.modem.sms_received_callback = self._on_sms
         connected = False
+        delay = 1
         while connected == False:
             try:
-                self.modem = gsmmodem.GsmModem("/dev/ttyS0", baudrate)
-                self.modem.connect()
+                await self.modem.connect()
                 connected = True
             except Exception as e:
-                self.exception_handler(e, "connecting the modem. Trying again")
-        if self.log:
-            print("Connecting relay board")
-        self.relay_board = seeed_relay_v1.Relay(device_address=relay_board_address)
-        self.missing_responses = 0
-        self.water = False
-        self.times_water_detected = 0
-        self.relay_board.on(red_relay)
-        time.sleep(1)
-        self.relay_board.off(red_relay)
-        self.relay_board.on(amber_relay)
-        time.sleep(1)
-        self.relay_board.off(amber_relay)
-        self.relay_board.on(green_relay)
-        time.sleep(1)
-        self.relay_board.off(green_relay)
-
-    def request_status(self):
+                await self.exception_handler(e, f"connecting the modem. Trying again in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        self._set_relays(self._lights_mask)
+        await asyncio.sleep(1)
+        self._set_relays(0)
+
+    def _set_relays(self, mask: int):
+        """Switches the light relays set in 'mask' on and the other light relays off, in a single I2C write where possible."""
+        board = self.relay_board
+        if not self._register_access:
+            for relay in (self.red_relay, self.amber_relay, self.green_relay):
+                if mask & (1 << (relay - 1)):
+                    board.on(relay)
+                else:
+                    board.off(relay)
+            return
+        # the board's data register is active low; keep it in sync so the Relay methods still work
+        board.DEVICE_REG_DATA = (board.DEVICE_REG_DATA | self._lights_mask) & ~mask & 0xFF
+        board.bus.write_byte_data(board.DEVICE_ADDRESS, board.DEVICE_REG_MODE1, board.DEVICE_REG_DATA)
+
+    async def request_status(self):
         """Sends a message to the given number to check for water."""
-        self.send_message(self.phone_number, self.request_message)
         self.missing_loops = 0
         self.awaiting_message = True
-        if self.log:
-            print("Sent request.")
+        await self.send_message(self.phone_number, self.request_message)
+        logger.info("Queued request.")
 
-    def check_for_answer(self):
-        """Checks if the other device has sent an answer yet."""
-        try:
-            messages = self.modem.listStoredSms(delete=True)
-        except Exception as e:
-            self.exception_handler(e, "checking for new messages")
-            messages = []
+    def _on_sms(self, index: int):
+        """Called by the modem when it has stored a new message."""
+        self.new_sms.set()
+
+    async def check_for_answer(self, poll: bool = False):
+        """Checks if the other device has sent an answer yet.
+
+        The modem's storage is only read after it has reported a new message,
+        or if 'poll' is set, which catches messages whose report was missed.
+        """
+        messages = []
+        if self.new_sms.is_set() or poll:
+            self.new_sms.clear()
+            try:
+                messages = await self.modem.list_stored_sms(delete=True)
+            except Exception as e:
+                await self.exception_handler(e, "checking for new messages")
         if len(messages) == 0 and self.awaiting_message:
             self.missing_loops += 1
         for message in messages:
-            self.parse_message(message)
+            await self.parse_message(message)
 
-    def parse_message(self, message):
-        """Turns relays on and off depending on the message contents. 'message' should be a gsmmodem SMS object."""
+    async def parse_message(self, message):
+        """Turns relays on and off depending on the message contents. 'message' should be an async_modem Sms object."""
         if message.number == self.phone_number:
-            if message.text == self.water_message or message.text == self.no_water_message:
-                if self.missing_responses >= self.disconnect_time / 2:
-                    self.alert_humans("restored")
+            handler = self._message_handlers.get(message.text)
+            if handler:
+                if self.missing_responses >= self._disconnect_threshold:
+                    await self.transition("restored")
                 self.missing_loops = 0
                 self.missing_responses = 0
                 self.awaiting_message = False
-            if message.text == self.water_message:
-                self.times_water_detected += 1
-                self.update_status()
-            elif message.text == self.no_water_message:
-                self.times_water_detected = 0
-                self.update_status()
+                await handler()
             else:
-                print(f"Unknown message '{message.text}'")
+                logger.warning("Unknown message '%s'", message.text)
         else:
-            print(f"Unknown number {message.number}")
+            logger.warning("Unknown number %s", message.number)
+
+    async def _on_water(self):
+        """Handles the other device reporting water."""
+        self.times_water_detected += 1
+        await self.update_status()
 
-    def update_status(self):
+    async def _on_no_water(self):
+        """Handles the other device reporting no water."""
+        self.times_water_detected = 0
+        await self.update_status()
+
+    async def update_status(self):
         """Handles the aount of times water needs to be detected."""
         if self.times_water_detected == 0:
             self.light("green")
             if self.water:
-                self.alert_humans("removed")
+                await self.transition("removed")
             self.water = False
-            if self.log:
-                print(f"Received '{self.no_water_message}', turning green light on.")
-        elif 0 < self.times_water_detected < self.water_time / 2:
-            print(f"Water has been detected for {self.times_water_detected * 2}m. Will alert others at {self.water_time}m.")
-        elif self.times_water_detected >= self.water_time / 2:
+            logger.info("Received '%s', turning green light on.", self.no_water_message)
+        elif 0 < self.times_water_detected < self._water_threshold:
+            logger.warning("Water has been detected for %sm. Will alert others at %sm.", self.times_water_detected * 2, self.water_time)
+        elif self.times_water_detected >= self._water_threshold:
             self.light("red")
-            self.alert_humans("water")
+            await self.transition("water")
             self.water = True
-            print(f"Water has been detected for the past {self.times_water_detected * 2}m, turning red light on.")
+            logger.warning("Water has been detected for the past %sm, turning red light on.", self.times_water_detected * 2)
     
-    def exception_handler(self, e, task):
+    async def exception_handler(self, e, task):
         """Logs exceptions."""
-        print(f"Encountered a {e.__class__.__name__} while {task}.")
-        if not self.relay_board.get_port_status(self.amber_relay):
-            self.relay_board.on(self.amber_relay)
-            time.sleep(1)
-            self.relay_board.off(self.amber_relay)
-        if self.log:
+        logger.error("Encountered a %s while %s.", e.__class__.__name__, task)
+        amber = self._light_masks["amber"]
+        if not self._current_mask & amber:
+            self._set_relays(self._current_mask | amber)
+            await asyncio.sleep(1)
+            self._set_relays(self._current_mask)
+        if logger.isEnabledFor(logging.DEBUG):
             try:
-                print(f"Signal strength: {modem.signalStrength} / 100")
-            except Exception as e:
-                print("Unable to get signal strength.")
+                logger.debug("Signal strength: %s / 31", await self.signal_strength())
+            except Exception:
+                logger.debug("Unable to get signal strength.")
+
+    async def signal_strength(self):
+        """Returns the modem's signal strength, reusing the last reading for 30 seconds."""
+        if time.monotonic() - self._last_csq_time > 30:
+            self._last_csq = await self.modem.signal_strength()
+            self._last_csq_time = time.monotonic()
+        return self._last_csq
 
     def light(self, light):
         """Manages the lights"""
-        if light == "red":
-            self.relay_board.off(self.amber_relay)
-            self.relay_board.off(self.green_relay)
-            self.relay_board.on(self.red_relay)
-        elif light == "amber":
-            self.relay_board.off(self.green_relay)
-            # self.relay_board.off(self.red_relay) - this is commented in case water is detected and then the connection is lost - now it will keep the red light
-            self.relay_board.on(self.amber_relay)
-        elif light == "green":
-            self.relay_board.off(self.amber_relay)
-            self.relay_board.off(self.red_relay)
-            self.relay_board.on(self.green_relay)
-        else:
-            print(f"Unknown light {light}.")
+        if light not in self._light_masks:
+            logger.error("Unknown light %s.", light)
+            return
+        mask = self._light_masks[light]
+        if light == "amber":
+            # keep the red light in case water is detected and then the connection is lost
+            mask |= self._current_mask & self._light_masks["red"]
+        if mask != self._current_mask:
+            self._set_relays(mask)
+            self._current_mask = mask
+
+    async def transition(self, event: str):
+        """Moves the alert state machine along 'event', alerting humans only when the state changes."""
+        new_state = ALERT_TRANSITIONS.get((self._state, event))
+        if new_state is None:
+            return
+        self._state = new_state
+        await self.alert_humans(event)
 
-    def alert_humans(self, event: str):
+    async def alert_humans(self, event: str):
         """Alerts all phone numbers on the 'alert_numbers' list to a given event."""
-        for number in self.alert_numbers:
-            if event == "water":
-                self.send_message(number, f"Water has been detected at XFEL for the past {self.times_water_detected * 2}m!")
-            elif event == "disconnect":
-                self.send_message(number, f"The connection to the flood monitoring system at XFEL has been lost for {self.missing_responses * 2}m.")
-            elif event == "restored":
-                self.send_message(number, "The connection to the flood monitoring system has been restored.")
-            elif event == "removed":
-                self.send_message(number, "The water is no longer detected.")
-            else:
-                raise ValueError(f"Unknown event {event}")
+        if event == "water":
+            body = f"Water has been detected at XFEL for the past {self.times_water_detected * 2}m!"
+        elif event == "disconnect":
+            body = f"The connection to the flood monitoring system at XFEL has been lost for {self.missing_responses * 2}m."
+        elif event == "restored":
+            body = "The connection to the flood monitoring system has been restored."
+        elif event == "removed":
+            body = "The water is no longer detected."
+        else:
+            raise ValueError(f"Unknown event {event}")
+        await self.send_message_batch(self.alert_numbers, body)
 
-    def send_message(self, number : str, message : str):
-        try:
-            self.modem.sendSms(number, message)
-        except Exception as e:
-            self.exception_handler(e, f"sending message '{message}' to {number}")
+    async def send_message(self, number : str, message : str):
+        """Queues a message to be sent by the sender loop."""
+        await self._send_queue.put((number, message, 0))
 
-    def mainloop(self):
+    async def send_message_batch(self, numbers : list, message : str):
+        """Queues the same message for every number in 'numbers'."""
+        for number in numbers:
+            await self._send_queue.put((number, message, 0))
+
+    async def _sender_loop(self):
+        """Sends queued messages. Waits 200ms after the first message of a burst so the whole burst goes out in one modem session."""
+        while True:
+            batch = [await self._send_queue.get()]
+            await asyncio.sleep(0.2)
+            while not self._send_queue.empty():
+                batch.append(self._send_queue.get_nowait())
+            recipients = {}  # message -> {number: failed attempts so far}
+            for number, message, attempts in batch:
+                recipients.setdefault(message, {}).setdefault(number, attempts)
+            for message, attempts in recipients.items():
+                try:
+                    failed = await self.modem.send_sms_batch(list(attempts), message)
+                except Exception as e:
+                    await self.exception_handler(e, f"sending message '{message}' to {', '.join(attempts)}")
+                    failed = dict.fromkeys(attempts, e)
+                else:
+                    for number, e in failed.items():
+                        await self.exception_handler(e, f"sending message '{message}' to {number}")
+                for number, e in failed.items():
+                    self._retry(number, message, attempts[number] + 1, e)
+
+    def _retry(self, number : str, message : str, attempts : int, e: Exception):
+        """Queues a failed message again after a delay that doubles with each attempt, up to 60 seconds.
+
+        Gives up after MAX_SEND_ATTEMPTS, or straight away on a ValueError,
+        which means the number or message can't be encoded.
+        """
+        if isinstance(e, ValueError) or attempts >= MAX_SEND_ATTEMPTS:
+            logger.error("Giving up on sending message '%s' to %s after %s attempt(s).", message, number, attempts)
+            return
+        delay = min(2 ** (attempts - 1), 60)
+        logger.warning("Retrying message '%s' to %s in %ss.", message, number, delay)
+        asyncio.get_running_loop().call_later(delay, self._send_queue.put_nowait, (number, message, attempts))
+
+    async def mainloop(self):
         """The main program."""
+        await self.connect()
+        sender = asyncio.create_task(self._sender_loop())
+        tick = 2 if debug else 10
         try:
+            # sleep until fixed deadlines so time spent talking to the modem
+            # doesn't stretch the 2 minute loops
+            next_tick = time.monotonic()
             while True:
                 for i in range(12):
                     if i == 0:
-                        self.request_status()
-                    if debug:
-                        time.sleep(2)
-                    else:
-                        time.sleep(10)
-                    self.check_for_answer()
+                        await self.request_status()
+                    next_tick += tick
+                    await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+                    if sender.done():
+                        sender.result()  # re-raises whatever stopped the sender
+                        raise RuntimeError("The SMS sender stopped.")
+                    await self.check_for_answer(poll=i == 11)
                 if self.missing_loops == 12:  # full loop without a response
                     self.missing_responses += 1
-                    print(f"No answer received in the last {self.missing_responses * 2}m!")
-                if self.missing_responses >= self.disconnect_time / 2:
-                    print(f"No answer received in the last {self.missing_responses * 2} minutes, turning amber light on.")
+                    logger.warning("No answer received in the last %sm!", self.missing_responses * 2)
+                if self.missing_responses >= self._disconnect_threshold:
+                    logger.warning("No answer received in the last %s minutes, turning amber light on.", self.missing_responses * 2)
                     self.light("amber")
-                    self.alert_humans("disconnect")
+                    await self.transition("disconnect")
         finally:
+            sender.cancel()
             self.relay_board.all_off()
             self.modem.close()
-if log_everything:
-    log.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
-
-phone_number = os.environ["phone_number"]
-alert_phone_numbers = json.loads(os.environ["alert_phone_numbers"])
-
-wateralarm = WaterAlarm(
-    phone_number=phone_number,
-    request_message="Water?",
-    water_message="1",
-    no_water_message="0",
-    relay_board_address=0x20,
-    baudrate = 19200,
-    red_relay=1,
-    amber_relay=2,
-    green_relay=3,
-    log=logging,
-    alert_phone_numbers=alert_phone_numbers,
-    disconnect_time=10,
-    water_time=4 
-    )
-
-wateralarm.mainloop()
+
+
+def main():
+    """Reads the phone numbers from the environment and runs the water alarm."""
+    dotenv.load_dotenv()
+
+    # log records are written to the console by a background thread so slow
+    # output never holds up the event loop
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG if log_everything else logging.INFO, handlers=[QueueHandler(log_queue)])
+    log_listener = QueueListener(log_queue, logging.StreamHandler())
+    log_listener.start()
+
+    phone_number = os.environ["phone_number"]
+    alert_phone_numbers = json.loads(os.environ["alert_phone_numbers"])
+
+    try:
+        wateralarm = WaterAlarm(
+            phone_number=phone_number,
+            request_message="Water?",
+            water_message="1",
+            no_water_message="0",
+            relay_board_address=0x20,
+            baudrate = 19200,
+            red_relay=1,
+            amber_relay=2,
+            green_relay=3,
+            alert_phone_numbers=alert_phone_numbers,
+            disconnect_time=10,
+            water_time=4 
+            )
+        asyncio.run(wateralarm.mainloop())
+    finally:
+        log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
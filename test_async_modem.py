@@ -0,0 +1,162 @@
+import asyncio
+import unittest
+
+from async_modem import AsyncGsmModem, CommandError, encode_address, encode_user_data
+
+
+class FakeSerial:
+    """Stands in for the modem's serial port, answering AT commands the way a modem would."""
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+        self.text_mode = True
+        self.prompt = True
+        self.prompt_delay = 0
+        self.stored = []  # (index, number, text)
+        self.sent = []  # (text mode, AT+CMGS command, payload)
+        self.pending_send = None
+        self.buffer = b""
+
+    def reply(self, data: bytes, delay: float = 0):
+        asyncio.get_running_loop().call_later(delay, self.reader.feed_data, data)
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while self.buffer:
+            if self.pending_send is not None:
+                if self.buffer.startswith(b"\x1b"):
+                    self.buffer = self.buffer[1:]
+                    self.pending_send = None
+                    self.reply(b"\r\nOK\r\n", delay=0.05)
+                elif b"\x1a" in self.buffer:
+                    payload, self.buffer = self.buffer.split(b"\x1a", 1)
+                    self.sent.append(self.pending_send + (payload.decode(),))
+                    self.pending_send = None
+                    self.reply(b"\r\n+CMGS: 1\r\n\r\nOK\r\n")
+                else:
+                    return
+            elif b"\r" in self.buffer:
+                command, self.buffer = self.buffer.split(b"\r", 1)
+                self.answer(command.decode())
+            else:
+                return
+
+    def answer(self, command: str):
+        if command.startswith("AT+CMGF="):
+            self.text_mode = command.endswith("1")
+            self.reply(b"\r\nOK\r\n")
+        elif command == 'AT+CMGL="ALL"':
+            if not self.text_mode:
+                self.reply(b"\r\n+CMS ERROR: 302\r\n")
+                return
+            listing = "".join(f'\r\n+CMGL: {index},"REC UNREAD","{number}",,"24/01/01,12:00:00+04"\r\n{text}'
+                              for index, number, text in self.stored)
+            self.reply(listing.encode() + b"\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CMGD="):
+            index = int(command.split("=")[1])
+            self.stored = [message for message in self.stored if message[0] != index]
+            self.reply(b"\r\nOK\r\n")
+        elif command.startswith("AT+CMGS"):
+            self.pending_send = (self.text_mode, command)
+            if self.prompt:
+                self.reply(b"\r\n> ", delay=self.prompt_delay)
+        elif command == "AT+CSQ":
+            self.reply(b"\r\n+CSQ: 17,99\r\n\r\nOK\r\n")
+        else:
+            self.reply(b"\r\nOK\r\n")
+
+    def close(self):
+        pass
+
+
+class EncodingTest(unittest.TestCase):
+    def test_encode_user_data_packs_gsm_septets(self):
+        self.assertEqual(encode_user_data("hellohello"), (0x00, 10, bytes.fromhex("E8329BFD4697D9EC37")))
+
+    def test_encode_user_data_falls_back_to_ucs2(self):
+        self.assertEqual(encode_user_data("中"), (0x08, 2, "中".encode("utf-16-be")))
+
+    def test_encode_user_data_rejects_long_messages(self):
+        with self.assertRaises(ValueError):
+            encode_user_data("x" * 161)
+
+    def test_encode_address(self):
+        self.assertEqual(encode_address("+491234567"), bytes.fromhex("099194214365F7"))
+        self.assertEqual(encode_address("01701234"), bytes.fromhex("088110072143"))
+
+    def test_encode_address_rejects_formatted_numbers(self):
+        for number in ("+49 170 1234567", "0170-1234567", "", "+"):
+            with self.assertRaises(ValueError):
+                encode_address(number)
+
+
+class AsyncGsmModemTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.modem = AsyncGsmModem("/dev/null", 19200, timeout=0.5)
+        self.modem._reader = asyncio.StreamReader()
+        self.serial = FakeSerial(self.modem._reader)
+        self.modem._writer = self.serial
+        self.modem._read_task = asyncio.create_task(self.modem._read_loop())
+        self.modem._text_mode = True
+
+    async def asyncTearDown(self):
+        self.modem.close()
+
+    async def test_list_stored_sms_reads_and_deletes(self):
+        self.serial.stored = [(1, "+49111", "1"), (2, "+49111", "two\nlines")]
+        messages = await self.modem.list_stored_sms(delete=True)
+        self.assertEqual([(m.index, m.number, m.text) for m in messages],
+                         [(1, "+49111", "1"), (2, "+49111", "two\nlines")])
+        self.assertEqual(self.serial.stored, [])
+
+    async def test_message_text_that_looks_like_a_result_code(self):
+        self.serial.stored = [(1, "+49222", "ERROR"), (2, "+49222", "OK"), (3, "+49111", "0")]
+        messages = await self.modem.list_stored_sms(delete=True)
+        self.assertEqual([m.text for m in messages], ["ERROR", "OK", "0"])
+        self.assertEqual(await self.modem.signal_strength(), 17)
+
+    async def test_empty_message(self):
+        self.serial.stored = [(1, "+49111", "0"), (2, "+49222", "")]
+        messages = await self.modem.list_stored_sms(delete=True)
+        self.assertEqual([m.text for m in messages], ["0", ""])
+        self.assertEqual(self.serial.stored, [])
+
+    async def test_error_response(self):
+        self.serial.text_mode = False  # out of step with the driver
+        with self.assertRaises(CommandError):
+            await self.modem.list_stored_sms()
+
+    async def test_timed_out_message_input_is_cancelled(self):
+        self.serial.prompt = False
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.modem.command("AT+CMGS=15", payload="00AA", timeout=0.1)
+        # the modem's late answer to the ESC must not complete the next send
+        self.serial.prompt = True
+        self.serial.prompt_delay = 0.1
+        await self.modem.command("AT+CMGS=15", payload="00BB")
+        self.assertEqual(self.serial.sent, [(True, "AT+CMGS=15", "00BB")])
+
+    async def test_send_sms_batch_skips_invalid_numbers(self):
+        failed = await self.modem.send_sms_batch(["+49111", "0170-1234567", "+49222"], "Water?")
+        self.assertEqual(list(failed), ["0170-1234567"])
+        self.assertIsInstance(failed["0170-1234567"], ValueError)
+        self.assertEqual(len(self.serial.sent), 2)
+
+    async def test_sending_and_listing_dont_switch_modes_under_each_other(self):
+        self.serial.stored = [(1, "+49111", "1")]
+        for first, second in ((self.modem.send_sms_batch(["+49111", "+49222", "+49333"], "Water?"), self.modem.list_stored_sms()),
+                              (self.modem.list_stored_sms(), self.modem.send_sms_batch(["+49111", "+49222", "+49333"], "Water?"))):
+            self.serial.sent = []
+            await asyncio.gather(first, second)
+            self.assertEqual([text_mode for text_mode, _, _ in self.serial.sent], [False] * 3)
+
+    async def test_new_message_indication(self):
+        indices = []
+        self.modem.sms_received_callback = indices.append
+        self.modem._reader.feed_data(b'\r\n+CMTI: "SM",7\r\n')
+        await asyncio.sleep(0.01)
+        self.assertEqual(indices, [7])
+
+
+if __name__ == "__main__":
+    unittest.main()